@@ -56,23 +56,31 @@ import pandas as pd
 import datetime as dt
 import matplotlib.pyplot as plt
 import seaborn as sns
-from sklearn.metrics import silhouette_samples, silhouette_score
+from sklearn.metrics import silhouette_samples, silhouette_score, adjusted_rand_score
 
 from sklearn.cluster import KMeans
-from sklearn.cluster import AgglomerativeClustering
 from sklearn.mixture import GaussianMixture
 from sklearn.cluster import DBSCAN
 
-from sklearn import metrics
+from scipy.cluster.hierarchy import ward, cut_tree
 from yellowbrick.cluster import KElbowVisualizer
 from yellowbrick.cluster import SilhouetteVisualizer
+from yellowbrick.utils.kneed import KneeLocator
 from sklearn.preprocessing import RobustScaler,StandardScaler
 from sklearn.preprocessing import PowerTransformer
 
 import squarify
+import hashlib
+import json
+import sqlite3
+import time
+import tracemalloc
 import warnings
 warnings.filterwarnings("ignore")
 
+# Fixed seed shared by every estimator so that reruns are reproducible
+SEED = 1
+
 
 
 
@@ -181,25 +189,80 @@ def rfm_level(df):
 
 """### C. Elbow method: Optimal K"""
 
+# Feature matrix
+
+FEATURES = ['Recency','Monetary', 'delay_in_delivery','Review_score']
+
+def feature_matrix(rfm, dtype=np.float32):
+  '''Un seul tableau C-contigu (float32 par défaut) des variables du modèle, standardisé sur place.
+  Ce même buffer alimente KMeans, DBSCAN, la CAH (ward) et GaussianMixture sans autre copie.'''
+  x = np.empty((len(rfm), len(FEATURES)), dtype=dtype, order='C')
+  mean = np.empty(len(FEATURES))
+  std = np.empty(len(FEATURES))
+
+  # Same scaling as StandardScaler, one column at a time so that the only float64
+  # temporary is a single column, centered and scaled in place before being written back
+  for j, column in enumerate(FEATURES):
+    c = rfm[column].to_numpy(dtype=np.float64, copy=True)
+    mean[j] = c.mean()
+    c -= mean[j]
+    std[j] = np.sqrt(np.dot(c, c) / len(c))
+    if std[j] == 0:
+      std[j] = 1
+    c /= std[j]
+    x[:, j] = c
+  return x, mean, std
+
+def peak_memory(func, *args, **kwargs):
+  '''Exécute func et renvoie son résultat et le pic mémoire (en Mo) mesuré par tracemalloc.'''
+  tracemalloc.start()
+  try:
+    result = func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+  return result, peak / 1e6
+
 # K means
 
-def Elbow(rfm):
+def weighted_inertias(x_scaled, sample_weight):
+  # Weighted inertia of KMeans for k = 2..7, the range of the KElbowVisualizer sweeps
+  k_values = list(range(2, 8))
+  inertias = [KMeans(k, random_state=SEED).fit(x_scaled, sample_weight=sample_weight).inertia_
+              for k in k_values]
+  return k_values, inertias
+
+def Elbow(rfm, dtype=np.float32, sample_weight=None, x_scaled=None):
+  # x_scaled: rows already scaled, e.g. x_full[core_idx], so that the coreset is not rescaled on its own
 
-  rfm_model = pd.DataFrame()
-  rfm_model = rfm[['Recency','Monetary', 'delay_in_delivery','Review_score']] # 'delay_in_delivery',
-  Standard = StandardScaler()
-  x_scaled = pd.DataFrame()
-  x_scaled = Standard.fit_transform(rfm_model)
-  # x_scaled = Standard.fit(rfm_model)
+  # No column copy: kmeans adds cluster_pred to the caller's frame
+  rfm_model = rfm # 'delay_in_delivery',
+  if x_scaled is None:
+    x_scaled, _, _ = feature_matrix(rfm, dtype)
 
 
   # Elbow method
 
-  model = KMeans()
-  visualizer = KElbowVisualizer(model, k=(2,8))
-  visualizer.fit(x_scaled)
-  optimal_k = visualizer.elbow_value_
-  visualizer.show()
+  if sample_weight is None:
+    model = KMeans(random_state=SEED)
+    visualizer = KElbowVisualizer(model, k=(2,8))
+    visualizer.fit(x_scaled)
+    optimal_k = visualizer.elbow_value_
+    visualizer.show()
+  else:
+    # KElbowVisualizer scores each k with an unweighted distortion, which overweights the outlying
+    # coreset rows: the weighted inertia is used instead, with the visualizer's elbow locator
+    k_values, inertias = weighted_inertias(x_scaled, sample_weight)
+    optimal_k = KneeLocator(k_values, inertias, curve_nature='convex', curve_direction='decreasing').knee
+
+    plt.plot(k_values, inertias, marker='D')
+    if optimal_k is not None:
+      plt.axvline(optimal_k, c='k', linestyle='--', label=f'elbow at k = {optimal_k}')
+      plt.legend()
+    plt.xlabel('k')
+    plt.ylabel('weighted inertia')
+    plt.title('Elbow method on the weighted coreset')
+    plt.show()
 
   return rfm_model, x_scaled, optimal_k
 
@@ -207,12 +270,14 @@ def Elbow(rfm):
 
 """
 
-def kmeans(rfm_model, x_scaled, k):
-  kmeans_scaled = KMeans(k)
-  kmeans_scaled.fit(rfm_model)
-  identified_clusters = kmeans_scaled.fit_predict(rfm_model)
-  clusters_scaled = rfm_model.copy()
-  clusters_scaled['cluster_pred']=kmeans_scaled.fit_predict(x_scaled)
+def kmeans(rfm_model, x_scaled, k, sample_weight=None):
+  '''Attention : modifie rfm_model, qui reçoit la colonne cluster_pred et est renvoyé comme clusters_scaled.
+  rfm_model est le DataFrame passé à Elbow, sans copie des colonnes du modèle.'''
+  kmeans_scaled = KMeans(k, random_state=SEED)
+
+  # The labels are added to rfm_model in place, which then serves as clusters_scaled without a copy
+  clusters_scaled = rfm_model
+  clusters_scaled['cluster_pred']=kmeans_scaled.fit_predict(x_scaled, sample_weight=sample_weight)
 
   return clusters_scaled, kmeans_scaled
 
@@ -235,40 +300,75 @@ def Plot3D(clusters_scaled):
 
   ax.scatter3D(xline, zline,yline,c=clusters_scaled['cluster_pred'])
 
-def visualizer(x_scaled, m):
+def visualizer(x_scaled, m, sample_weight=None):
   # 'calinski_harabasz' , 'silhouette_score'
-  model = KMeans(random_state=123)
-  visualizer = KElbowVisualizer(model, k=(2,8), metric= m, timings=True)
-  visualizer.fit(x_scaled)
-  visualizer.poof()
+  if sample_weight is None:
+    model = KMeans(random_state=123)
+    visualizer = KElbowVisualizer(model, k=(2,8), metric= m, timings=True)
+    visualizer.fit(x_scaled)
+    visualizer.poof()
+    return
+
+  # Weighted coreset: Calinski-Harabasz from the fitted weighted inertia, n being the total weight
+  if m != 'calinski_harabasz':
+    raise ValueError("only 'calinski_harabasz' is available with sample_weight")
+  k_values, inertias = weighted_inertias(x_scaled, sample_weight)
+  n = np.sum(sample_weight)
+  centered = x_scaled - np.average(x_scaled, axis=0, weights=sample_weight)
+  total = np.einsum('i,ij,ij->', sample_weight, centered, centered)
+  scores = [(total - inertia) / (k - 1) / (inertia / (n - k)) for k, inertia in zip(k_values, inertias)]
+
+  plt.plot(k_values, scores, marker='D')
+  plt.xlabel('k')
+  plt.ylabel('weighted calinski_harabasz score')
+  plt.title('Calinski-Harabasz score on the weighted coreset')
+  plt.show()
 
 def Validation(x_scaled, kmeans_scaled,k):
 
   sil_score = silhouette_score(x_scaled, kmeans_scaled.labels_, metric='euclidean')
   print('Silhouette Score: %.2f' % sil_score)
 
-  model = KMeans(k)
+  model = KMeans(k, random_state=SEED)
   visualizer = SilhouetteVisualizer(model)
   visualizer.fit(x_scaled)
   visualizer.poof()
 
-def Snakeplot(rfm_melted, hue, title):
-  sns.lineplot(x = 'metrics', y = 'value', hue = hue, data = rfm_melted)
+def Snakeplot(cube, hue, title):
+  # Standardized mean of each metric per group, with a 95% confidence band, read from the profiling cube
+  order = list(cube.index.unique(level='metric'))
+  overall = cube_stats(cube).reindex(order)
+  stats = cube_stats(cube, hue)
+  for group, s in stats.groupby(level=hue):
+    s = s.droplevel(hue).reindex(order)
+    mean = (s['mean'] - overall['mean']) / overall['pop_std']
+    half = 1.96 * s['std'] / np.sqrt(s['count']) / overall['pop_std']
+    plt.plot(order, mean.values, label=group)
+    plt.fill_between(order, (mean - half).values, (mean + half).values, alpha=0.2)
+  plt.xlabel('metrics')
+  plt.ylabel('value')
   plt.title(title)
   plt.legend(loc = 'upper right')
 
-def Cluster_description(rfm_model):
+def Cluster_description(cube, scaled=False):
 
+  overall = cube_stats(cube)
+  stats = cube_stats(cube, 'cluster')
   colonne_cluster = ['Recency', 'Review_score', 'Monetary']
   for column in colonne_cluster:
       try:
+          s = stats.xs(column, level='metric')
+          mean, sd = s['mean'], s['std']
+          if scaled:
+              mean = (mean - overall.loc[column, 'mean']) / overall.loc[column, 'pop_std']
+              sd = sd / overall.loc[column, 'pop_std']
           plt.figure(figsize=(10,6))
           titre = 'Moyenne de ' + str(column) + ' pour chaque cluster'
           plt.title(titre)
-          sns.barplot(x = 'cluster',
-                      y = column,
-                      data = rfm_model,
-                      ci="sd")
+          plt.bar(mean.index.astype(str), mean.values, yerr=sd.values, capsize=4,
+                  color=sns.color_palette(n_colors=len(mean)))
+          plt.xlabel('cluster')
+          plt.ylabel(column)
           plt.show()
 
       except:
@@ -276,56 +376,356 @@ def Cluster_description(rfm_model):
 
 """### F. ARI and K-Means"""
 
-# Define a function to create multiple data frames based on a base period and time lapse
-def create_data_frames(base, timelapse):
-    base_df = data2[(data2['order_approved_at'] >= data2['order_approved_at'].min()) & (data2['order_approved_at'] < data2['order_approved_at'].min() + pd.DateOffset(months=base))]
-    data_frames = [base_df]
-    max_date = data2['order_approved_at'].max()
-    current_date = data2['order_approved_at'].min() + pd.DateOffset(months=timelapse)
-    while current_date + pd.DateOffset(months=base) <= max_date:
-        data_frames.append(data2[(data2['order_approved_at'] >= current_date) & (data2['order_approved_at'] < current_date + pd.DateOffset(months=timelapse+base))])
-        current_date += pd.DateOffset(months=timelapse)
-    return data_frames
-
-def kmeans_pipe(dataframe):
+def kmeans_pipe(rfm):
+  # rfm: the window features, e.g. window_frame(rfm_windows, window_customers, i)
   k_cluster = 0
-  rfm = dataframe.groupby('customer_unique_id').agg({'order_approved_at' : lambda x : (now - x.max()).days,
-                                'order_id': lambda num : len(num),
-                                'payment_value': lambda price : price.sum()
 
+  rfm_model, x_scaled, k_cluster = Elbow(rfm)
+  clusters_scaled, kmeans_scaled = kmeans(rfm_model, x_scaled, k_cluster)
+  # clusters_scaled.groupby(['cluster_pred']).count()
 
-                              })
+  return rfm, rfm_model, x_scaled, clusters_scaled, kmeans_scaled
 
-  col_list = ['Recency','Frequency','Monetary']
+def window_labels(pipe):
+  # Labels of a kmeans_pipe result, indexed by customer
+  rfm, clusters_scaled = pipe[0], pipe[3]
+  return pd.Series(clusters_scaled['cluster_pred'].to_numpy(), index=rfm['customer_unique_id'].to_numpy())
 
-  # Rename the columns
+def common_ari(labels1, labels2):
+  '''ARI entre deux segmentations, sur les clients présents dans les deux fenêtres.'''
+  common = labels1.index.intersection(labels2.index)
+  return adjusted_rand_score(labels1[common], labels2[common])
 
-  rfm.rename(columns={'order_approved_at': 'Recency',
-                          'order_id': 'Frequency',
-                          'payment_value': 'Monetary'}, inplace=True)
+"""### G. Resumable sweeps
 
-  # Calculate Reviewscore
+Each completed (algorithm, params, data, window) cell is appended to a SQLite results store,
+so a sweep interrupted by a Colab timeout restarts where it stopped instead of from scratch.
+"""
 
-  Reviewscore = data2.drop_duplicates().groupby(
-    by=['customer_unique_id'], as_index=False)['review_score'].mean()
-  Reviewscore.columns = ['customer_unique_id', 'Review_score']
+def open_results(path):
+  con = sqlite3.connect(path)
+  con.execute('''CREATE TABLE IF NOT EXISTS sweep_results (
+                   algo TEXT, params TEXT, data TEXT, window INTEGER, metrics TEXT,
+                   PRIMARY KEY (algo, params, data, window))''')
+  return con
+
+def fingerprint(*arrays):
+  '''Empreinte (dtype, shape et contenu) des données d'entrée d'une sweep.'''
+  digest = hashlib.sha1()
+  for array in arrays:
+    array = np.ascontiguousarray(array)
+    digest.update(f'{array.dtype.str}{array.shape}'.encode())
+    digest.update(array.tobytes())
+  return digest.hexdigest()
+
+def run_sweep(con, algo, grid, fit, data, window=0):
+  '''fit(params) renvoie un dict de métriques ; les cellules déjà en base pour la même empreinte data
+  ne sont pas recalculées. Une erreur de fit n'est pas enregistrée : elle remonte, et la cellule sera relancée.'''
+  results = []
+  for params in grid:
+    key = json.dumps(params, sort_keys=True)
+    row = con.execute('SELECT metrics FROM sweep_results WHERE algo=? AND params=? AND data=? AND window=?',
+                      (algo, key, data, window)).fetchone()
+    if row is not None:
+      scores = json.loads(row[0])
+    else:
+      scores = fit(params)
+      con.execute('INSERT INTO sweep_results VALUES (?, ?, ?, ?, ?)',
+                  (algo, key, data, window, json.dumps(scores)))
+      con.commit()
+    results.append((params, scores))
+  return results
 
-  # Calculate Delay_in_delivery
+"""### H. Vectorized clustering scores
 
-  Delay = data2.drop_duplicates().groupby(
-      by=['customer_unique_id'], as_index=False)['delay_in_delivery'].mean()
-  Delay.columns = ['customer_unique_id', 'delay_in_delivery']
+The global statistics of x_scaled are computed once; label vectors are then scored with
+np.bincount reductions instead of recomputing sklearn's calinski_harabasz_score on the raw matrix.
+"""
 
-  # Merge
+def score_stats(x_scaled):
+  x = np.asarray(x_scaled, dtype=np.float64)
+  sq = np.einsum('ij,ij->i', x, x)
+  total = x.sum(axis=0)
+  total_ss = sq.sum() - total @ total / len(x)
+  return {'x': x, 'sq': sq, 'total_ss': total_ss}
+
+def score_labels(stats, labels_list):
+  '''Calinski-Harabasz, Davies-Bouldin, inertie, tailles des clusters et bruit pour plusieurs vecteurs de labels.
+  Comme dans sklearn, le bruit (-1) compte comme un cluster pour CH et DB, qui valent nan avec moins de 2 clusters.'''
+  x, sq, total_ss = stats['x'], stats['sq'], stats['total_ss']
+  n, d = x.shape
+
+  # -1 (bruit) -> 0, then one block of n_bins bins per label vector
+  codes = np.vstack([np.asarray(labels) for labels in labels_list]).astype(np.int64) + 1
+  m = codes.shape[0]
+  n_bins = int(codes.max()) + 1
+  flat = (codes + n_bins * np.arange(m)[:, None]).ravel()
+
+  counts = np.bincount(flat, minlength=m * n_bins).reshape(m, n_bins)
+  sums = np.stack([np.bincount(flat, weights=np.tile(x[:, j], m), minlength=m * n_bins)
+                   for j in range(d)], axis=1).reshape(m, n_bins, d)
+  sq_sums = np.bincount(flat, weights=np.tile(sq, m), minlength=m * n_bins).reshape(m, n_bins)
+
+  centroids = sums / np.maximum(counts, 1)[:, :, None]
+  inertia = (sq_sums - np.einsum('rkd,rkd->rk', sums, centroids)).sum(axis=1)
+
+  scores = []
+  for r in range(m):
+    present = counts[r] > 0
+    k = int(present.sum())
+    ch, db = np.nan, np.nan
+    if 1 < k < n:
+      ch = 1.0 if inertia[r] == 0 else (total_ss - inertia[r]) * (n - k) / (inertia[r] * (k - 1))
+
+      dist = np.linalg.norm(x - centroids[r][codes[r]], axis=1)
+      intra = np.bincount(codes[r], weights=dist, minlength=n_bins)[present] / counts[r][present]
+      c = centroids[r][present]
+      centroid_dist = np.sqrt(((c[:, None, :] - c[None, :, :]) ** 2).sum(axis=2))
+      if np.allclose(intra, 0) or np.allclose(centroid_dist, 0):
+        db = 0.0
+      else:
+        centroid_dist[centroid_dist == 0] = np.inf
+        db = np.max((intra[:, None] + intra[None, :]) / centroid_dist, axis=1).mean()
+
+    scores.append({'n_clusters': k - int(present[0]),
+                   'n_noise': int(counts[r, 0]),
+                   'sizes': counts[r, 1:codes[r].max() + 1].tolist(),
+                   'calinski_harabasz': float(ch),
+                   'davies_bouldin': float(db),
+                   'inertia': float(inertia[r])})
+  return scores
+
+"""### I. Profiling cube
+
+count, sum, sum of squares, min and max of each metric per (segment, cluster), computed in one groupby pass.
+Profiling tables, snake plots and cluster descriptions are derived from this cube instead of the customer rows.
+"""
 
-  rfm = rfm.merge(Reviewscore, how='inner', on='customer_unique_id')
-  rfm = rfm.merge(Delay, how='inner', on='customer_unique_id')
+def profile_cube(df, keys, columns):
+  values = df[columns].astype(float)
+  frame = values.join((values ** 2).add_suffix('_sq'))
+  frame[keys] = df[keys]
+  spec = {column: ['count', 'sum', 'min', 'max'] for column in columns}
+  spec.update({column + '_sq': 'sum' for column in columns})
+  agg = frame.groupby(keys).agg(spec)
+
+  cube = pd.concat({column: pd.DataFrame({'count': agg[(column, 'count')],
+                                          'sum': agg[(column, 'sum')],
+                                          'sumsq': agg[(column + '_sq', 'sum')],
+                                          'min': agg[(column, 'min')],
+                                          'max': agg[(column, 'max')]})
+                    for column in columns}, names=['metric'])
+  return cube.reorder_levels(list(keys) + ['metric'])
+
+def cube_stats(cube, by=None):
+  '''Agrège le cube sur `by` (une clé, une liste de clés, ou tout le cube si None), par métrique.
+  std est l'écart-type de l'échantillon (comme pandas), pop_std celui de la population (comme StandardScaler).'''
+  levels = ([by] if isinstance(by, str) else list(by or [])) + ['metric']
+  g = cube.groupby(level=levels)
+  out = g[['count', 'sum', 'sumsq']].sum().join(g['min'].min()).join(g['max'].max())
+  out['mean'] = out['sum'] / out['count']
+  ss = (out['sumsq'] - out['sum'] * out['mean']).clip(lower=0)
+  out['std'] = np.sqrt(ss / (out['count'] - 1).where(out['count'] > 1))
+  out['pop_std'] = np.sqrt(ss / out['count'])
+  return out
+
+def profile_table(cube, by, spec):
+  '''Équivalent de df.groupby(by).agg(spec) pour count, sum, min, max, mean et std.'''
+  stats = cube_stats(cube, by)
+  return pd.concat({column: stats.xs(column, level='metric')[list(funcs)]
+                    for column, funcs in spec.items()}, axis=1)
+
+"""### J. Drift monitoring
+
+The reference window is summarized once (quantile bins, feature histograms, scaling, centroids and mean
+distance to the nearest centroid); new batches only update counters, and a retrain signal is raised
+when PSI, KS or the distance to the centroids drift past their thresholds.
+"""
 
-  rfm_model, x_scaled, k_cluster = Elbow(X)
-  clusters_scaled, kmeans_scaled = kmeans(rfm_model, x_scaled, k_cluster)
-  # clusters_scaled.groupby(['cluster_pred']).count()
+def drift_reference(rfm_model, kmeans_scaled, n_bins=10):
+  columns = FEATURES
+  x = rfm_model[columns].to_numpy(dtype=np.float64)
+  std = x.std(axis=0)
+  reference = {'columns': columns,
+               'mean': x.mean(axis=0),
+               'scale': np.where(std == 0, 1, std),
+               'centroids': kmeans_scaled.cluster_centers_,
+               # inner quantile edges, the first and last bins are open-ended
+               'edges': [np.unique(np.quantile(x[:, j], np.linspace(0, 1, n_bins + 1)[1:-1]))
+                         for j in range(len(columns))]}
+  state = drift_update(drift_state(reference), reference, rfm_model)
+  reference['probs'] = [counts / state['n'] for counts in state['counts']]
+  reference['distance'] = state['distance'] / state['n']
+  return reference
+
+def drift_state(reference):
+  return {'n': 0, 'distance': 0.0, 'counts': [np.zeros(len(edges) + 1) for edges in reference['edges']]}
+
+def drift_assign(reference, batch):
+  '''Cluster le plus proche et distance à son centroïde, dans l'échelle de la référence.'''
+  x = batch[reference['columns']].to_numpy(dtype=np.float64)
+  z = (x - reference['mean']) / reference['scale']
+  distances = np.sqrt(((z[:, None, :] - reference['centroids'][None, :, :]) ** 2).sum(axis=2))
+  labels = distances.argmin(axis=1)
+  return labels, distances[np.arange(len(x)), labels]
+
+def drift_update(state, reference, batch):
+  x = batch[reference['columns']].to_numpy(dtype=np.float64)
+  for j, edges in enumerate(reference['edges']):
+    state['counts'][j] += np.bincount(np.searchsorted(edges, x[:, j], side='right'), minlength=len(edges) + 1)
+
+  _, distances = drift_assign(reference, batch)
+  state['distance'] += distances.sum()
+  state['n'] += len(x)
+  return state
+
+def drift_check(state, reference, psi_max=0.2, ks_max=0.1, distance_max=1.2):
+  '''PSI et KS (sur les histogrammes) par variable, et distance moyenne au centroïde rapportée à la référence.
+  retrain vaut True dès qu'un des seuils est dépassé.'''
+  n = max(state['n'], 1)
+  psi, ks = {}, {}
+  for column, p, counts in zip(reference['columns'], reference['probs'], state['counts']):
+    q = counts / n
+    p_safe, q_safe = np.clip(p, 1e-6, None), np.clip(q, 1e-6, None)
+    psi[column] = float(np.sum((q_safe - p_safe) * np.log(q_safe / p_safe)))
+    ks[column] = float(np.abs(np.cumsum(q) - np.cumsum(p)).max())
+  distance = state['distance'] / n
+  if reference['distance'] > 0:
+    distance_ratio = float(distance / reference['distance'])
+  else:
+    # Every reference customer sits on its centroid: any distance at all is drift
+    distance_ratio = 1.0 if distance == 0 else np.inf
+
+  retrain = max(psi.values()) > psi_max or max(ks.values()) > ks_max or distance_ratio > distance_max
+  return {'psi': psi, 'ks': ks, 'distance_ratio': distance_ratio, 'retrain': bool(retrain)}
+
+def reference_to_json(reference):
+  # Arrays as lists, so that a reference can be kept in the results store
+  return {key: [np.asarray(v).tolist() for v in value] if key in ('edges', 'probs')
+               else value.tolist() if isinstance(value, np.ndarray) else value
+          for key, value in reference.items()}
+
+def reference_from_json(reference):
+  return {key: [np.asarray(v) for v in value] if key in ('edges', 'probs')
+               else np.asarray(value) if key in ('mean', 'scale', 'centroids') else value
+          for key, value in reference.items()}
+
+"""### K. Coreset
+
+Lightweight coreset (Bachem et al., 2018): customers are drawn with a probability that mixes a uniform
+term and their squared distance to the mean, then weighted by the inverse probability. Small, far-off
+groups such as "Can't Loose Them" stay represented, unlike in a uniform rfm.sample.
+"""
 
-  return rfm, rfm_model, x_scaled, clusters_scaled, kmeans_scaled
+def coreset(x_scaled, m, random_state=SEED):
+  '''Indices (sans doublon) et poids des clients du coreset, tirés m fois parmi les lignes de x_scaled.'''
+  rng = np.random.default_rng(random_state)
+  x = np.asarray(x_scaled)
+
+  # Squared distance to the mean, one column at a time to avoid n x d float64 temporaries
+  mean = x.mean(axis=0, dtype=np.float64)
+  d2 = np.zeros(len(x))
+  for j in range(x.shape[1]):
+    c = x[:, j] - mean[j]
+    c *= c
+    d2 += c
+  q = 0.5 / len(x) + 0.5 * d2 / d2.sum()
+
+  idx, draws = np.unique(rng.choice(len(x), size=m, p=q), return_counts=True)
+  return idx, draws / (m * q[idx])
+
+def coreset_report(x_scaled, k, sizes, random_state=SEED):
+  '''Inertie (rapportée au fit complet) et ARI sur toute la population des KMeans ajustés
+  sur un coreset pondéré et sur un échantillon uniforme de même taille.'''
+  start = time.time()
+  full = KMeans(k, random_state=random_state).fit(x_scaled)
+  rows = [{'method': 'full', 'size': len(x_scaled), 'inertia_ratio': 1.0, 'ari': 1.0,
+           'fit_seconds': time.time() - start}]
+
+  rng = np.random.default_rng(random_state)
+  for m in sizes:
+    core_idx, core_weights = coreset(x_scaled, m, random_state)
+    samples = {'coreset': (core_idx, core_weights),
+               'uniform': (rng.choice(len(x_scaled), size=m, replace=False), None)}
+    for method, (idx, weights) in samples.items():
+      start = time.time()
+      model = KMeans(k, random_state=random_state).fit(x_scaled[idx], sample_weight=weights)
+      seconds = time.time() - start
+      labels = model.predict(x_scaled)
+      rows.append({'method': method, 'size': len(idx),
+                   'inertia_ratio': -model.score(x_scaled) / full.inertia_,
+                   'ari': adjusted_rand_score(full.labels_, labels),
+                   'fit_seconds': seconds})
+  return pd.DataFrame(rows)
+
+"""### L. Multi-window RFM
+
+Every window is computed from a single sort of the orders by (customer, date): prefix sums are taken over the
+sorted columns once, and each window then costs two searchsorted calls per customer instead of a groupby on a copy.
+"""
+
+RFM_COLUMNS = ['Recency', 'Frequency', 'Monetary', 'Review_score', 'delay_in_delivery']
+
+def window_bounds(dates, base, timelapse):
+  '''(start, end) des fenêtres : base mois au départ, puis timelapse + base mois, décalées de timelapse mois.'''
+  first, max_date = dates.min(), dates.max()
+  windows = [(first, first + pd.DateOffset(months=base))]
+  current_date = first + pd.DateOffset(months=timelapse)
+  while current_date + pd.DateOffset(months=base) <= max_date:
+    windows.append((current_date, current_date + pd.DateOffset(months=timelapse+base)))
+    current_date += pd.DateOffset(months=timelapse)
+  return windows
+
+def build_rfm_windows(orders, windows, date=None):
+  '''Tenseur (fenêtre, client, RFM_COLUMNS), nan pour les clients sans commande dans la fenêtre, et les clients.
+  La Recency est calculée par rapport à date (par défaut now), ou à la dernière commande de chaque fenêtre si date='last'.'''
+  codes, customers = pd.factorize(orders['customer_unique_id'], sort=True)
+  times = orders['order_approved_at'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+  unique_times, time_ranks = np.unique(times, return_inverse=True)
+
+  # Sort key (customer, date rank): each customer owns the block [c * span, (c + 1) * span)
+  span = len(unique_times) + 1
+  key = codes.astype(np.int64) * span + time_ranks
+  order = np.argsort(key, kind='stable')
+  key, times = key[order], times[order]
+
+  # Prefix sums of order count, payment, review score and delay over the sorted orders
+  values = np.column_stack([np.ones(len(order)),
+                            orders['payment_value'].to_numpy(dtype=np.float64)[order],
+                            orders['review_score'].to_numpy(dtype=np.float64)[order],
+                            orders['delay_in_delivery'].to_numpy(dtype=np.float64)[order]])
+  prefix = np.vstack([np.zeros((1, values.shape[1])), np.cumsum(values, axis=0)])
+
+  offsets = np.arange(len(customers), dtype=np.int64) * span
+  day = 86400 * 10**9
+  tensor = np.full((len(windows), len(customers), len(RFM_COLUMNS)), np.nan)
+  for w, (start, end) in enumerate(windows):
+    lo = np.searchsorted(key, offsets + np.searchsorted(unique_times, pd.Timestamp(start).value))
+    hi = np.searchsorted(key, offsets + np.searchsorted(unique_times, pd.Timestamp(end).value))
+    present = hi > lo
+    lo, hi = lo[present], hi[present]
+    sums = prefix[hi] - prefix[lo]
+    last = times[hi - 1]
+
+    if isinstance(date, str) and date == 'last':
+      reference = last.max() if len(last) else 0
+    else:
+      reference = pd.Timestamp(now if date is None else date).value
+
+    tensor[w, present, 0] = (reference - last) // day
+    tensor[w, present, 1] = sums[:, 0]
+    tensor[w, present, 2] = sums[:, 1]
+    tensor[w, present, 3] = sums[:, 2] / sums[:, 0]
+    tensor[w, present, 4] = sums[:, 3] / sums[:, 0]
+  return tensor, customers
+
+def window_frame(tensor, customers, w):
+  '''Clients de la fenêtre w : customer_unique_id puis RFM_COLUMNS, une ligne par client.'''
+  present = ~np.isnan(tensor[w, :, 1])
+  rfm = pd.DataFrame(tensor[w, present], columns=RFM_COLUMNS)
+  rfm[['Recency', 'Frequency']] = rfm[['Recency', 'Frequency']].astype(int)
+  rfm.insert(0, 'customer_unique_id', np.asarray(customers)[present])
+  return rfm
 
 """# I. Notebook de l'analyse exploratoire
 
@@ -447,10 +847,13 @@ rfm['RFM_Score'] = rfm[['R','D','M','S']].sum(axis=1)
 rfm['RFM_Level'] = rfm.apply(rfm_level, axis=1)
 display(rfm.head())
 
-rfm_stats = rfm.groupby('RFM_Level').agg({
-    'Recency': 'mean',
-    'Review_score':'mean',
-    'delay_in_delivery':'mean',
+# One pass over the customers; the segment tables below are read from this cube
+rfm_cube = profile_cube(rfm, ['RFM_Level'], ['Recency', 'Review_score', 'Frequency', 'delay_in_delivery', 'Monetary'])
+
+rfm_stats = profile_table(rfm_cube, 'RFM_Level', {
+    'Recency': ['mean'],
+    'Review_score':['mean'],
+    'delay_in_delivery':['mean'],
     'Monetary':['mean','count']
 }).round(1)
 
@@ -473,7 +876,7 @@ plt.show()
 
 rfm
 
-rfm.groupby('RFM_Level').agg({
+profile_table(rfm_cube, 'RFM_Level', {
     'Recency' : ['mean', 'min','max'],
     'Review_score' : ['mean', 'min','max'],
     'Frequency' : ['mean', 'min','max'],
@@ -511,7 +914,7 @@ Q3 = rfm.Review_score.quantile(0.75)
 IQR = Q3 - Q1
 rfm = rfm[(rfm.delay_in_delivery >= (Q1 - 1.5*IQR)) & (rfm.delay_in_delivery <= (Q3 + 1.5*IQR))]"""
 
-X = rfm.sample(9500, random_state=1).copy()
+X = rfm.sample(9500, random_state=SEED).copy()
 
 X
 
@@ -538,32 +941,37 @@ Validation(x_scaled, kmeans_scaled,4)
 
 # https://www.kaggle.com/code/pnarerdoan/k-means-dbscan-clustering/notebook
 
+# Results store on Drive, so that it survives a runtime disconnect
+results_path = '/content/drive/My Drive/Colab Notebooks/sweep_results_project_4.db'
+con = open_results(results_path)
+
+# Global statistics of x_scaled, shared by the DBSCAN, CAH and GMM scoring
+stats = score_stats(x_scaled)
+
+# Cached sweep cells are only reused for this exact x_scaled
+data_key = fingerprint(x_scaled)
+
 epsilon = [1,1.25,1.5,1.75, 2,2.25,2.5,2.75, 3,3.25,3.5,3.75, 4]
 min_samples = [10,15,20,25]
 
-calinski_harabasz_avg = 0
-calinski_avg = []
-max_value = [0,0,0,0]
+def fit_dbscan(params):
+  db = DBSCAN(eps=params['eps'], min_samples=params['min_samples']).fit(x_scaled)
 
-for i in range(len(epsilon)):
-    for j in range(len(min_samples)):
-      try:
-        db = DBSCAN(min_samples = min_samples[j], eps =epsilon[i]).fit(x_scaled)
-        core_samples_mask = np.zeros_like(db.labels_, dtype=bool)
-        core_samples_mask[db.core_sample_indices_] = True
-        labels = db.labels_
+  # n_clusters ignores noise; n_noise counts the -1 labels
+  return score_labels(stats, [db.labels_])[0]
 
-        # Number of clusters in labels, ignoring noise if present.
-        n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
-        n_noise_ = list(labels).count(-1)
+grid = [{'eps': eps, 'min_samples': ms} for eps in epsilon for ms in min_samples]
+results = run_sweep(con, 'dbscan', grid, fit_dbscan, data_key)
 
-        calinski_harabasz_avg = metrics.calinski_harabasz_score(x_scaled, labels)
+calinski_avg = []
+max_value = [0,0,0,0]
 
-        if calinski_harabasz_avg > max_value[3]:
-            max_value=(epsilon[i], min_samples[j], n_clusters_, calinski_harabasz_avg)
-        calinski_avg.append(calinski_harabasz_avg)
-      except:
-        s = 0
+for params, scores in results:
+  if np.isnan(scores['calinski_harabasz']):
+    continue
+  if scores['calinski_harabasz'] > max_value[3]:
+      max_value=(params['eps'], params['min_samples'], scores['n_clusters'], scores['calinski_harabasz'])
+  calinski_avg.append(scores['calinski_harabasz'])
 
 print("epsilon=", max_value[0],
       "\nmin_sample=", max_value[1],
@@ -574,27 +982,25 @@ print("epsilon=", max_value[0],
 
 # Hierachical clustering model
 
-calinski_harabasz_avg = 0
-sil_avg = []
-max_value = [0,0]
-n_clusters = 2
-
-for i in range(2,8):
-  hc = AgglomerativeClustering(n_clusters = i).fit(x_scaled)
-  core_samples_mask = np.zeros_like(hc.labels_, dtype=bool)
-
+def fit_cah(params):
+  # One Ward tree (the AgglomerativeClustering default linkage), cut at every level,
+  # and all the label vectors scored in a single batched call
+  tree = ward(x_scaled)
+  labels = cut_tree(tree, n_clusters=params['n_clusters']).T
+  return {'levels': score_labels(stats, labels)}
 
-  labels = hc.labels_
+grid = [{'n_clusters': list(range(2,8))}]
+params, cah = run_sweep(con, 'cah', grid, fit_cah, data_key)[0]
 
-  # Number of clusters in labels, ignoring noise if present.
-  n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
-  n_noise_ = list(labels).count(-1)
-
-  calinski_harabasz_avg = metrics.calinski_harabasz_score(x_scaled, labels)
+sil_avg = []
+max_value = [0,0]
 
-  if calinski_harabasz_avg > max_value[1]:
-      max_value=(n_clusters_, calinski_harabasz_avg)
-  sil_avg.append(calinski_harabasz_avg)
+for scores in cah['levels']:
+  if np.isnan(scores['calinski_harabasz']):
+    continue
+  if scores['calinski_harabasz'] > max_value[1]:
+      max_value=(scores['n_clusters'], scores['calinski_harabasz'])
+  sil_avg.append(scores['calinski_harabasz'])
 
 print("\nnumber of clusters=", max_value[0],
       "\naverage calinski_harabasz score= %.4f" % max_value[1])
@@ -604,28 +1010,22 @@ print("\nnumber of clusters=", max_value[0],
 n_components = [2, 3, 4, 5, 6]
 n_init = [2,3,4,5,6]
 
-calinski_harabasz_avg = 0
-calinski_avg = []
-max_value = [0, 0, 0, 0]
-n_clusters = 1
-
-for i in range(len(n_components)):
-  for j in range(len(n_init)):
-    try:
-      gmm = GaussianMixture(n_components=n_components[i], n_init=n_init[j], random_state=1, tol=1e-4, init_params='kmeans', max_iter=1000,).fit(x_scaled)
-      labels = gmm.predict(x_scaled)
+def fit_gmm(params):
+  gmm = GaussianMixture(n_components=params['n_components'], n_init=params['n_init'], random_state=SEED, tol=1e-4, init_params='kmeans', max_iter=1000,).fit(x_scaled)
+  return score_labels(stats, [gmm.predict(x_scaled)])[0]
 
-      # Number of clusters in labels, ignoring noise if present.
-      n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
-      n_noise_ = list(labels).count(-1)
+grid = [{'n_components': nc, 'n_init': ni} for nc in n_components for ni in n_init]
+results = run_sweep(con, 'gmm', grid, fit_gmm, data_key)
 
-      calinski_harabasz_avg = metrics.calinski_harabasz_score(x_scaled, labels)
+calinski_avg = []
+max_value = [0, 0, 0, 0]
 
-      if calinski_harabasz_avg > max_value[3]:
-          max_value = [n_components[i], n_init[j], n_clusters_, calinski_harabasz_avg]
-      calinski_avg.append(calinski_harabasz_avg)
-    except:
-      s = 0
+for params, scores in results:
+  if np.isnan(scores['calinski_harabasz']):
+    continue
+  if scores['calinski_harabasz'] > max_value[3]:
+      max_value = [params['n_components'], params['n_init'], scores['n_clusters'], scores['calinski_harabasz']]
+  calinski_avg.append(scores['calinski_harabasz'])
 
 print("n_components=", max_value[0],
       "\nn_init=", max_value[1],
@@ -639,69 +1039,84 @@ print("n_components=", max_value[0],
 ## K-means on all Data
 """
 
-rfm_model, x_scaled, k_clusters  = Elbow(rfm)
+# Set to True to also measure the previous StandardScaler pipeline; it is kept out of the default run
+# since it rebuilds the float64 copies that the peak below is meant to leave out
+MEASURE_BASELINE = False
+if MEASURE_BASELINE:
+  _, peak_scaler = peak_memory(lambda: StandardScaler().fit_transform(rfm[FEATURES]))
+  print(f"Peak memory, StandardScaler: {peak_scaler:.1f} MB")
+
+# Peak memory of the whole section, from the feature matrix to the cluster plots
+tracemalloc.start()
+x_full, _, _ = feature_matrix(rfm)
+
+# Weighted coreset of the whole population: the K sweep runs on it instead of on every customer
+# The coreset rows keep the full-population scaling, shared by the K sweep and the final fit
+core_idx, core_weights = coreset(x_full, 9500)
+x_core = x_full[core_idx]
+_, _, k_clusters = Elbow(rfm.iloc[core_idx], sample_weight=core_weights, x_scaled=x_core)
 
 """According to the Elbow method, the number of clusters is 4."""
 
-kmeans_scaled = KMeans(4)
-kmeans_scaled.fit(rfm_model)
-identified_clusters = kmeans_scaled.fit_predict(rfm_model)
-clusters_scaled = rfm_model.copy()
-clusters_scaled['cluster_pred']=kmeans_scaled.fit_predict(x_scaled)
+# Coreset and uniform-sample fits against the full fit. This one-off quality check holds the only
+# full-population fit and can be skipped once the coreset size is validated
+display(coreset_report(x_full, 4, [2000, 5000, 9500]))
+
+# Final model fitted on the weighted coreset, then every customer assigned to its nearest centroid
+kmeans_scaled = KMeans(4, random_state=SEED).fit(x_core, sample_weight=core_weights)
+# The labels are attached to rfm itself rather than to a float64 copy of the model columns
+rfm['cluster_pred'] = kmeans_scaled.predict(x_full)
+clusters_scaled = rfm
 sns.set(style="darkgrid")
 print(" Our cluster centers are as follows")
 print(kmeans_scaled.cluster_centers_)
 f, ax = plt.subplots(figsize=(15,7))
 ax = sns.countplot(x="cluster_pred", data=clusters_scaled)
-clusters_scaled.groupby(['cluster_pred']).count()
+clusters_scaled.groupby(['cluster_pred'])[FEATURES].count()
 
 Plot3D(clusters_scaled)
 
-visualizer(x_scaled,'calinski_harabasz')
+visualizer(x_core,'calinski_harabasz', sample_weight=core_weights)
+
+peak_section = tracemalloc.get_traced_memory()[1] / 1e6
+tracemalloc.stop()
+print(f"Feature data: {x_full.nbytes / 1e6:.1f} MB")
+print(f"Peak memory, K-means on all Data: {peak_section:.1f} MB ({peak_section / (x_full.nbytes / 1e6):.1f}x the feature data)")
 
 """## 1. Cluster Profiling"""
 
-rfm_model['cluster']= clusters_scaled['cluster_pred']
-rfm_model['level']=rfm['RFM_Level']
+# Sufficient statistics per (segment, cluster, metric), computed in one pass;
+# the profiling table and every plot below are drawn from it
+
+cube = profile_cube(rfm, ['RFM_Level', 'cluster_pred'], FEATURES).rename_axis(
+    index={'RFM_Level': 'level', 'cluster_pred': 'cluster'})
+display(cube.head())
 
-rfm_model.groupby('cluster').agg({
+profile_table(cube, 'cluster', {
     'Recency' : ['mean','min','max'],
     'Review_score' : ['mean','min','max'],
     'Monetary' : ['mean','min','max','count']
 })
 
-rfm_scaled=pd.DataFrame()
-rfm_scaled=rfm_model.copy()
-scaler=StandardScaler()
-rfm_scaled[['Recency', 'Review_score','Monetary']] = scaler.fit_transform(rfm_scaled[['Recency', 'Review_score','Monetary']])
-rfm_scaled['cust_id']= rfm_model.index
-display (rfm_scaled.head())
-
-
-# Melting the dataframe
-
-rfm_melted=pd.DataFrame()
-rfm_melted = pd.melt(frame= rfm_scaled, id_vars= ['cust_id', 'level', 'cluster'], var_name = 'metrics', value_name = 'value')
-display(rfm_melted.head())
-
 """## 2. Snake plot"""
 
 # Snake plot based on RFM segmentation
-Snakeplot(rfm_melted, 'level', 'Snake Plot of RFM')
+Snakeplot(cube, 'level', 'Snake Plot of RFM')
 
 # Snake plot with clusters using K-Means
-Snakeplot(rfm_melted, 'cluster', 'Snake Plot of Clusters')
+Snakeplot(cube, 'cluster', 'Snake Plot of Clusters')
 
 plt.figure(figsize=(15,6))
 plt.title('Distribution du nombre d\'individus par cluster, en pourcentage')
-sns.barplot(x = rfm_melted['cluster'].value_counts().index,
-           y= rfm_melted['cluster'].value_counts().values/len(rfm_melted)*100)
+cluster_sizes = cube_stats(cube, 'cluster').xs('Recency', level='metric')['count']
+sns.barplot(x = cluster_sizes.index,
+           y= cluster_sizes.values/cluster_sizes.sum()*100)
 
 """## 3. Cluster Description"""
 
-Cluster_description(rfm_model)
+Cluster_description(cube)
 
-Cluster_description(rfm_scaled)
+Cluster_description(cube, scaled=True)
 
 """# IV. ARI"""
 
@@ -720,27 +1135,58 @@ data2.to_csv(csv_file_path, index=False)
 
 base = 12  # Base period (in months)
 month_window = 1  # Month window
-data_frames = create_data_frames(base, month_window)  # Generate data frames
+windows = window_bounds(data2['order_approved_at'], base, month_window)  # Generate the windows
 
+# Features of every window in one pass over the orders, Recency taken at each window's last order
+rfm_windows, window_customers = build_rfm_windows(data2, windows, date='last')
 
-# Print the number of data frames created
-print(f"{len(data_frames)} data frames created.")
+# Print the number of windows created
+print(f"{len(windows)} windows created.")
 
-n = len(data_frames)
+n = len(windows)
 for i in range(0,n):
-  print(len(data_frames[i]))
-
-from sklearn.metrics import adjusted_rand_score
-ari_values = []
-base_df = data_frames[0]  # Use the same base data frame for each iteration
-clustering1 = kmeans_pipe(base_df)[-1]  # Get the KMeans object from the last step of kmeans_pipe
-
-for i in range(n):
-    subsequent_df = data_frames[i]
-    clustering2 = kmeans_pipe(subsequent_df)[-1]
-    ari = adjusted_rand_score(clustering1.labels_, clustering2.labels_)
-    ari_values.append(ari)
-
+  print(int(np.nansum(rfm_windows[i, :, 1])))  # orders in the window
+
+# Cached ARI cells are only reused for these exact window features
+windows_key = fingerprint(rfm_windows)
+
+# Base window: clustered once, then kept as the drift reference until a window drifts
+base_rfm = window_frame(rfm_windows, window_customers, 0)
+base_pipe = kmeans_pipe(base_rfm)
+labels1 = window_labels(base_pipe)  # Base window labels, by customer
+reference = drift_reference(base_pipe[1], base_pipe[-1])
+
+def fit_ari(params):
+  # Refit of a drifted window on its own features; windows hold different customers,
+  # so the two segmentations are compared on the customers present in both.
+  # The new drift reference is stored with the ARI, so a resumed run does not refit the window again
+  pipe = kmeans_pipe(window_frame(rfm_windows, window_customers, params['window']))
+  return {'ari': common_ari(labels1, window_labels(pipe)),
+          'reference': reference_to_json(drift_reference(pipe[1], pipe[-1]))}
+
+ari_values = [1.0]  # Base window against itself
+drift_reports = []
+refits = []
+for i in range(1, n):
+  # The window could also be fed in several batches, drift_update only accumulates counters
+  window_rfm = window_frame(rfm_windows, window_customers, i)
+  state = drift_update(drift_state(reference), reference, window_rfm)
+  report = drift_check(state, reference)
+  drift_reports.append(report)
+
+  if report['retrain']:
+    # Only drifted windows are refitted, one checkpointed cell each
+    params, scores = run_sweep(con, 'kmeans_drift_refit', [{'base': base, 'timelapse': month_window, 'window': i}],
+                               fit_ari, windows_key, window=i)[0]
+    reference = reference_from_json(scores['reference'])
+    refits.append(i)
+    ari_values.append(scores['ari'])
+  else:
+    # No drift: the current segmentation is kept and the window is assigned to its centroids
+    labels2 = pd.Series(drift_assign(reference, window_rfm)[0], index=window_rfm['customer_unique_id'].to_numpy())
+    ari_values.append(common_ari(labels1, labels2))
+
+print(f"{len(refits)} refits out of {n - 1} windows: {refits}")
 print(ari_values)
 
 # Plot ARI Trends
@@ -752,22 +1198,44 @@ for i in range(n):
     time_point = i * month_window
     time_points.append(time_point)
 
-# Plot ARI Trends
-plt.plot(time_points, ari_values, marker='o')
+# Plot ARI Trends: the two kinds of windows are two different measures, plotted as separate series
+fitted = [0] + refits
+assigned = [i for i in range(1, n) if i not in refits]
+plt.plot([time_points[i] for i in fitted], [ari_values[i] for i in fitted], 'o',
+         label='Base and drifted windows: own fit vs base labels')
+plt.plot([time_points[i] for i in assigned], [ari_values[i] for i in assigned], 's',
+         label='Windows without drift: current centroids vs base labels')
 plt.xlabel('Time Points')
 plt.ylabel('ARI Values')
 plt.title('ARI Trends over Time')
 plt.xticks(time_points)
+plt.legend()
 plt.grid(True)
 plt.show()
 
 ari_values
 
-"""The list of ARI values provided represents the similarity between the clustering results of the base data frame and each subsequent data frame.
+"""Each ARI value compares the base window labels with a later window's labels, on the customers present in both windows. The two series are different measures:
+
+* base and drifted windows (circles): the window is re-clustered on its own features, so the ARI compares two independent segmentations;
+* windows without drift (squares): the window is not re-clustered, its customers are assigned to the centroids of the current segmentation, so the ARI measures how many customers changed segment under an unchanged model.
 
 > Overall, the ARI values indicate a strong level of stability and consistency in the clustering results over time. The high ARI values indicate that the clustering patterns remain similar, with only minor variations observed in some cases. This suggests that the clustering approach captures meaningful patterns in the data and that the customer behavior or characteristics remain relatively consistent over the analyzed time periods.
+"""
+
+"""# V. Drift monitoring
 
-***Sources:***
+Drift reports of the ARI loop: each window was compared (PSI, KS, mean distance to the centroids) with the current
+reference, and only the windows raising a retrain signal were re-clustered; the others kept the current segmentation.
+"""
+
+pd.DataFrame([{'window': i + 1,
+               'max_psi': max(report['psi'].values()),
+               'max_ks': max(report['ks'].values()),
+               'distance_ratio': report['distance_ratio'],
+               'retrain': report['retrain']} for i, report in enumerate(drift_reports)])
+
+"""***Sources:***
 * https://github.com/smazzanti/are_you_still_using_elbow_method/blob/main/are-you-still-using-elbow-method.ipynb
 * https://towardsdatascience.com/are-you-still-using-the-elbow-method-5d271b3063bd
 * https://towardsdatascience.com/gaussian-mixture-models-vs-k-means-which-one-to-choose-62f2736025f0#:~:text=The%20first%20visible%20difference%20between,GMs%20is%20a%20probabilistic%20algorithm.
@@ -787,6 +1255,7 @@ ari_values
      - Applying K-Means
      - Visualizing the Clusters
      - ARI and K-Means
+     - Drift Monitoring
 
 3. Notebook: Exploratory Analysis
    - Data Cleaning and Exploration
@@ -806,5 +1275,7 @@ ari_values
 
 6. ARI Evaluation
 
-7. Conclusion
+7. Drift Monitoring
+
+8. Conclusion
 """